@@ -17,17 +17,23 @@ Output format (little-endian):
 
 Usage:
   python3 convert-video-to-ascii.py <input.mp4> <output.bin> [--fps 12] [--cols 120]
+                                    [--device cpu|cuda]
 """
 
 import argparse
+import math
 import os
+import queue
 import struct
 import subprocess
 import tempfile
+import threading
+from collections.abc import Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont
-from sklearn.cluster import MiniBatchKMeans
 
 
 def get_monospace_font(size: int) -> ImageFont.FreeTypeFont:
@@ -69,88 +75,438 @@ def build_glyph_templates(
     return chars, templates
 
 
-def structural_match_frame(
-    frame_gray: np.ndarray,
-    frame_rgb: np.ndarray,
-    templates: np.ndarray,
-    template_norms: np.ndarray,
-    kmeans: MiniBatchKMeans,
-    cols: int,
-    rows: int,
-    cell_w: int,
-    cell_h: int,
+def glyph_scorer(
+    templates_n: np.ndarray, device: str = "cpu",
+) -> Callable[[np.ndarray], np.ndarray]:
+    """
+    Return a function mapping (M, cell_h * cell_w) uint8 regions to the index
+    of the best-matching unit-norm template for each. "cpu" uses a NumPy
+    float32 GEMM; any other value is a torch device (e.g. "cuda") and runs an
+    fp16 GEMM there, which needs torch installed.
+    """
+    # Normalized cross-correlation for every region against every template in a
+    # single GEMM: dot(template, region) / (|template| * |region|). Templates
+    # are already unit norm and argmax over a row is unchanged by the positive
+    # 1 / |region| factor, so the raw dot products suffice. That is also scale
+    # invariant, so regions stay in raw [0, 255] units without a rescale pass.
+    if device == "cpu":
+        # This stays float32: NumPy only dispatches float matmul to BLAS, and
+        # its integer matmul loop is ~30x slower than SGEMM at these shapes
+        def best_cpu(regions: np.ndarray) -> np.ndarray:
+            return (regions.astype(np.float32) @ templates_n.T).argmax(axis=1)
+
+        return best_cpu
+
+    import torch
+
+    templates_t = torch.from_numpy(templates_n).to(device, torch.float16)
+
+    def best_torch(regions: np.ndarray) -> np.ndarray:
+        # Upload uint8 (a quarter of the float32 bytes) and cast on the device;
+        # dots peak around 255 * sqrt(cell_h * cell_w), well within fp16 range
+        regions_t = torch.from_numpy(regions).to(device).half()
+        return (regions_t @ templates_t.T).argmax(dim=1).cpu().numpy()
+
+    return best_torch
+
+
+@dataclass(frozen=True)
+class MatchContext:
+    """
+    Per-video matching constants, built once in main and shared by every
+    batch of frames so they are not recomputed per call.
+    """
+
+    cols: int
+    rows: int
+    cell_w: int
+    cell_h: int
+    # First index of each distinct template (identical templates always tie,
+    # and argmax keeps the first of them, so only these need scoring)
+    unique_idx: np.ndarray
+    # Maps (M, cell_h * cell_w) uint8 regions to positions in unique_idx
+    best_template: Callable[[np.ndarray], np.ndarray]
+
+    @classmethod
+    def build(
+        cls,
+        flat_templates_n: np.ndarray,
+        cols: int,
+        rows: int,
+        cell_w: int,
+        cell_h: int,
+        device: str = "cpu",
+    ) -> "MatchContext":
+        """flat_templates_n holds the (N, cell_h * cell_w) unit-norm templates."""
+        _, unique_idx = np.unique(flat_templates_n, axis=0, return_index=True)
+        unique_idx.sort()
+        return cls(
+            cols=cols,
+            rows=rows,
+            cell_w=cell_w,
+            cell_h=cell_h,
+            unique_idx=unique_idx,
+            best_template=glyph_scorer(flat_templates_n[unique_idx], device),
+        )
+
+    @property
+    def frame_shape(self) -> tuple[int, int]:
+        """(height, width) in pixels of a frame that tiles exactly into cells."""
+        return self.rows * self.cell_h, self.cols * self.cell_w
+
+
+def match_glyphs(
+    ctx: MatchContext,
+    frames_gray: np.ndarray,
+    prev_gray: np.ndarray | None = None,
+    prev_char_idx: np.ndarray | None = None,
+    chunk_size: int = 4096,
+    workers: int | None = None,
 ) -> np.ndarray:
     """
-    For each cell in the frame, find the character template that best matches
+    For each cell of every frame, find the character template that best matches
     the source image region using normalized cross-correlation.
-    Returns flat array of [charIdx, colorIdx] per cell.
+    Only cells whose pixels changed since the previous frame are matched; the
+    rest reuse the previous frame's result. prev_gray / prev_char_idx carry the
+    frame just before this batch and its result, when there is one.
+    Chunks of cells are matched on a pool of `workers` threads (default: one
+    per CPU). Returns (F, rows, cols) uint8 array of char indices.
     """
-    n_templates = templates.shape[0]
-    # Reshape templates for vectorized comparison: (N, cell_h * cell_w)
-    flat_templates = templates.reshape(n_templates, -1)
-
-    result = np.empty((rows, cols, 2), dtype=np.uint8)
-
-    for row in range(rows):
-        for col in range(cols):
-            y0 = row * cell_h
-            x0 = col * cell_w
-            region = frame_gray[y0 : y0 + cell_h, x0 : x0 + cell_w]
-
-            # Normalize region
-            region_flat = region.flatten().astype(np.float32) / 255.0
-            region_norm = np.linalg.norm(region_flat)
-
-            if region_norm < 1e-6:
-                # Nearly black region → space character (index 0)
-                result[row, col, 0] = 0
-            else:
-                # Normalized cross-correlation: dot(template, region) / (|template| * |region|)
-                dots = flat_templates @ region_flat
-                scores = dots / (template_norms * region_norm + 1e-8)
-                result[row, col, 0] = np.argmax(scores)
-
-            # Color: average color of the region, quantized to palette
-            rgb_region = frame_rgb[y0 : y0 + cell_h, x0 : x0 + cell_w]
-            avg_color = rgb_region.reshape(-1, 3).mean(axis=0).reshape(1, -1)
-            result[row, col, 1] = kmeans.predict(avg_color)[0]
-
-    return result.flatten()
-
-
-def extract_frames(
-    video_path: str, out_dir: str, fps: int, width: int, height: int,
-) -> list[str]:
-    """Extract frames from video using ffmpeg."""
-    pattern = os.path.join(out_dir, "frame_%04d.png")
+    cols, rows, cell_w, cell_h = ctx.cols, ctx.rows, ctx.cell_w, ctx.cell_h
+    n_frames = frames_gray.shape[0]
+    n_strips = n_frames * rows
+
+    def changed_cells(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        # Reduce over whole pixel rows first (contiguous), then within cells
+        diff = (a != b).reshape(-1, rows, cell_h, cols * cell_w).any(axis=2)
+        return diff.reshape(-1, rows, cols, cell_w).any(axis=3)
+
+    changed = np.ones((n_frames, rows, cols), dtype=bool)
+    changed[1:] = changed_cells(frames_gray[1:], frames_gray[:-1])
+    if prev_gray is not None and prev_char_idx is not None:
+        changed[0] = changed_cells(frames_gray[0], prev_gray)[0]
+    changed = changed.reshape(n_strips, cols)
+
+    # Zero-copy view of the video as (F * rows) strips of cols tiles, each
+    # (cell_h, cell_w). Tiles are only materialized one chunk at a time.
+    # Cells don't overlap, so scoring them as a block GEMM touches each pixel
+    # once per template; FFT cross-correlation would score every pixel offset
+    # and throw away all but 1 in cell_h * cell_w of the results.
+    tiles = (
+        frames_gray.reshape(n_frames, rows, cell_h, cols, cell_w)
+        .transpose(0, 1, 3, 2, 4)
+        .reshape(n_strips, cols, cell_h, cell_w)
+    )
+    strips_per_chunk = max(1, chunk_size // cols)
+
+    # Fully black regions keep the space character (index 0)
+    char_idx = np.zeros((n_strips, cols), dtype=np.uint8)
+
+    def match_chunk(start: int) -> None:
+        end = min(start + strips_per_chunk, n_strips)
+        # One contiguous (cells, cell_h * cell_w) copy of the changed cells in
+        # this chunk of strips
+        todo = changed[start:end]
+        if todo.all():
+            regions = np.ascontiguousarray(tiles[start:end])
+        else:
+            regions = tiles[start:end][todo]
+        regions = regions.reshape(-1, cell_h * cell_w)
+        lit = regions.any(axis=1)
+        todo_idx = np.zeros(len(regions), dtype=np.uint8)
+        todo_idx[lit] = ctx.unique_idx[ctx.best_template(regions[lit])]
+        char_idx[start:end][todo] = todo_idx
+
+    # Chunks write disjoint slices of char_idx, and NumPy releases the GIL for
+    # the copies, casts, GEMM and argmax, so threads run them in parallel
+    # without pickling frames across process boundaries
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        list(executor.map(match_chunk, range(0, n_strips, strips_per_chunk)))
+
+    # Carry unchanged cells forward from the previous frame, in frame order
+    char_idx = char_idx.reshape(n_frames, rows, cols)
+    changed = changed.reshape(n_frames, rows, cols)
+    for f in range(n_frames):
+        prev = char_idx[f - 1] if f else prev_char_idx
+        if prev is not None:
+            np.copyto(char_idx[f], prev, where=~changed[f])
+    return char_idx
+
+
+def average_cell_colors(ctx: MatchContext, frame_rgb: np.ndarray) -> np.ndarray:
+    """Return the (rows, cols, 3) uint8 average color of each cell in a frame."""
+    rows, cols, cell_w, cell_h = ctx.rows, ctx.cols, ctx.cell_w, ctx.cell_h
+    # Reduce over whole pixel rows first (contiguous), then within cells
+    sums = (
+        frame_rgb.reshape(rows, cell_h, cols * cell_w * 3)
+        .sum(axis=1, dtype=np.uint32)
+        .reshape(rows, cols, cell_w, 3)
+        .sum(axis=2)
+    )
+    return (sums // (cell_h * cell_w)).astype(np.uint8)
+
+
+def match_colors(cell_colors: np.ndarray, palette_lut: np.ndarray) -> np.ndarray:
+    """
+    Quantize average cell colors to 15-bit RGB and map them to palette indices
+    through the precomputed lookup table.
+    Returns (F, rows, cols) uint8 array of palette indices.
+    """
+    return palette_lut[rgb15_keys(cell_colors)]
+
+
+def read_frames(
+    video_path: str, fps: int, width: int, height: int,
+) -> Iterator[np.ndarray]:
+    """Decode frames with ffmpeg, piping raw RGB straight into memory."""
     cmd = [
-        "ffmpeg", "-i", video_path,
+        "ffmpeg", "-loglevel", "error", "-i", video_path,
         "-vf", f"fps={fps},scale={width}:{height}:flags=lanczos",
         "-pix_fmt", "rgb24",
-        "-y", pattern,
+        "-f", "rawvideo", "-",
     ]
-    subprocess.run(cmd, check=True, capture_output=True)
-    frames = sorted(
-        os.path.join(out_dir, f) for f in os.listdir(out_dir) if f.endswith(".png")
+    frame_size = width * height * 3
+    # stderr goes to a temp file rather than a pipe: a pipe nobody drains while
+    # we block on stdout would deadlock once ffmpeg logs more than its buffer
+    with tempfile.TemporaryFile() as stderr_file:
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr_file) as proc:
+            while True:
+                frame_bytes = proc.stdout.read(frame_size)
+                if len(frame_bytes) < frame_size:
+                    break
+                yield np.frombuffer(frame_bytes, dtype=np.uint8).reshape(height, width, 3)
+        if proc.returncode != 0:
+            stderr_file.seek(0)
+            raise subprocess.CalledProcessError(
+                proc.returncode, cmd, stderr=stderr_file.read(),
+            )
+
+
+def prefetch(items: Iterator[np.ndarray], maxsize: int = 16) -> Iterator[np.ndarray]:
+    """
+    Drain an iterator on a background thread into a bounded queue, so the
+    producer (e.g. ffmpeg decode) keeps running while the consumer computes.
+    Exceptions raised by the producer are re-raised in the consumer.
+    """
+    done = object()
+    buffer: queue.Queue = queue.Queue(maxsize=maxsize)
+
+    def produce() -> None:
+        try:
+            for item in items:
+                buffer.put(item)
+            buffer.put(done)
+        except BaseException as e:
+            buffer.put(e)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item = buffer.get()
+        if item is done:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+
+def probe_frame_count(video_path: str, fps: int) -> int:
+    """Estimate how many frames ffmpeg will emit at `fps`, or 0 if unknown."""
+    cmd = [
+        "ffprobe", "-v", "error",
+        "-show_entries", "format=duration",
+        "-of", "default=noprint_wrappers=1:nokey=1",
+        video_path,
+    ]
+    try:
+        result = subprocess.run(cmd, check=True, capture_output=True, text=True)
+        return math.ceil(float(result.stdout) * fps) + 1
+    except (OSError, subprocess.CalledProcessError, ValueError) as e:
+        print(f"  Could not probe video duration ({e}), growing buffers as needed")
+        return 0
+
+
+def analyze_frames(
+    ctx: MatchContext, video_path: str, fps: int, batch_frames: int = 16,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Stream frames out of ffmpeg and match glyphs one batch of frames at a time
+    while later frames are still being decoded. Full-resolution frames are not
+    kept: each is reduced to its average cell colors, and a subsample of its
+    pixels is added to a 15-bit color histogram for palette construction.
+    Output buffers are sized up front from the probed duration and only grow
+    if that estimate falls short.
+    Returns (char_idx (F, rows, cols), cell_colors (F, rows, cols, 3),
+    color_counts (32768,)).
+    """
+    height, width = ctx.frame_shape
+    capacity = max(probe_frame_count(video_path, fps), batch_frames)
+    char_idx = np.empty((capacity, ctx.rows, ctx.cols), dtype=np.uint8)
+    cell_colors = np.empty((capacity, ctx.rows, ctx.cols, 3), dtype=np.uint8)
+    color_counts = np.zeros(1 << 15, dtype=np.int64)
+    batch_gray = np.empty((batch_frames, height, width), dtype=np.uint8)
+    n_frames = 0
+    batch_start = 0
+    prev_gray = None
+
+    def flush() -> None:
+        nonlocal batch_start, prev_gray
+        batch = batch_gray[: n_frames - batch_start]
+        char_idx[batch_start:n_frames] = match_glyphs(
+            ctx, batch,
+            prev_gray=prev_gray,
+            prev_char_idx=char_idx[batch_start - 1] if batch_start else None,
+        )
+        prev_gray = batch[-1].copy()
+        batch_start = n_frames
+        print(f"  Processed {n_frames} frames")
+
+    frames = read_frames(video_path, fps, width, height)
+    for frame in prefetch(frames, maxsize=batch_frames):
+        if n_frames == len(char_idx):
+            char_idx = np.concatenate([char_idx, np.empty_like(char_idx)])
+            cell_colors = np.concatenate([cell_colors, np.empty_like(cell_colors)])
+        batch_gray[n_frames - batch_start] = to_grayscale(frame)
+        cell_colors[n_frames] = average_cell_colors(ctx, frame)
+        # Every 8th pixel is plenty to shape a 256-color palette
+        color_counts += np.bincount(
+            rgb15_keys(frame[::2, ::4]).ravel(), minlength=1 << 15,
+        )
+        n_frames += 1
+        if n_frames - batch_start == batch_frames:
+            flush()
+    if n_frames > batch_start:
+        flush()
+
+    return char_idx[:n_frames], cell_colors[:n_frames], color_counts
+
+
+def to_grayscale(frame_rgb: np.ndarray) -> np.ndarray:
+    """Convert an RGB frame to 8-bit luma using ITU-R BT.601 weights."""
+    # 8-bit fixed point (77 + 150 + 29 == 256), so the sum fits in uint16
+    rgb = frame_rgb.astype(np.uint16)
+    gray = (rgb[..., 0] * 77 + rgb[..., 1] * 150 + rgb[..., 2] * 29) >> 8
+    return gray.astype(np.uint8)
+
+
+def rgb15_keys(rgb: np.ndarray) -> np.ndarray:
+    """Pack 8-bit RGB values into 15-bit color keys (5 bits per channel)."""
+    q = rgb.astype(np.uint16) >> 3
+    return (q[..., 0] << 10) | (q[..., 1] << 5) | q[..., 2]
+
+
+def rgb15_colors(keys: np.ndarray) -> np.ndarray:
+    """Decode 15-bit color keys to the 8-bit RGB midpoint of each bin."""
+    return np.stack(
+        [(keys >> 10) & 0x1F, (keys >> 5) & 0x1F, keys & 0x1F], axis=-1,
+    ).astype(np.float32) * 8 + 4
+
+
+def split_color_box(
+    colors: np.ndarray, weights: np.ndarray,
+) -> tuple[float, np.ndarray]:
+    """
+    Find the axis-aligned cut of a box of weighted colors that minimizes the
+    summed squared error of the two halves (Wu's criterion), using cumulative
+    moments along each axis.
+    Returns (error reduction, boolean mask of the lower half).
+    """
+    sq = (colors**2).sum(axis=1)
+    total_w, total_wc, total_wc2 = weights.sum(), weights @ colors, weights @ sq
+    total_sse = total_wc2 - total_wc @ total_wc / total_w
+
+    best_sse, best_mask = np.inf, None
+    for axis in range(3):
+        order = np.argsort(colors[:, axis], kind="stable")
+        values = colors[order, axis]
+        # Moments of the lower half for a cut after each position
+        w = np.cumsum(weights[order])[:-1]
+        wc = np.cumsum(weights[order, None] * colors[order], axis=0)[:-1]
+        wc2 = np.cumsum(weights[order] * sq[order])[:-1]
+        sse = (wc2 - (wc**2).sum(axis=1) / w) + (
+            (total_wc2 - wc2) - ((total_wc - wc) ** 2).sum(axis=1) / (total_w - w)
+        )
+        # Only cut between distinct values so a bin never straddles the halves
+        sse[values[1:] == values[:-1]] = np.inf
+        cut = int(sse.argmin())
+        if sse[cut] < best_sse:
+            best_sse = sse[cut]
+            best_mask = colors[:, axis] <= values[cut]
+
+    return total_sse - best_sse, best_mask
+
+
+def weighted_means(
+    colors: np.ndarray, weights: np.ndarray, labels: np.ndarray, n: int,
+) -> np.ndarray:
+    """Return the (n, 3) float32 weighted mean color of each label (0 if unused)."""
+    total = np.bincount(labels, weights=weights, minlength=n)
+    sums = np.stack(
+        [np.bincount(labels, weights=weights * colors[:, c], minlength=n) for c in range(3)],
+        axis=1,
     )
-    print(f"  Extracted {len(frames)} frames at {fps}fps, {width}x{height}")
-    return frames
+    return (sums / np.maximum(total, 1e-12)[:, None]).astype(np.float32)
 
 
 def build_palette(
-    frames: list[np.ndarray], n_colors: int = 256,
-) -> tuple[np.ndarray, MiniBatchKMeans]:
-    """Build a global color palette from all frames."""
-    all_pixels = np.concatenate([f.reshape(-1, 3) for f in frames])
-    sample = all_pixels[::8].astype(np.float64)
-    print(f"  Clustering {len(sample)} sampled pixels into {n_colors} colors...")
-    kmeans = MiniBatchKMeans(
-        n_clusters=n_colors, random_state=42, batch_size=2048, n_init=3,
-    )
-    kmeans.fit(sample)
-    palette = kmeans.cluster_centers_.astype(np.uint8)
+    color_counts: np.ndarray, n_colors: int = 256,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Build a global color palette from a histogram of 15-bit colors over all
+    frames. Bins are split into n_colors boxes by greedy variance-minimizing
+    cuts (Wu-style), then refined with one weighted k-means pass, all on at
+    most 32768 weighted points.
+    Returns (palette uint8, centers float32), both (n_colors, 3).
+    """
+    bins = np.flatnonzero(color_counts)
+    colors = rgb15_colors(bins).astype(np.float64)
+    weights = color_counts[bins].astype(np.float64)
+
+    if len(bins) <= n_colors:
+        # Fewer distinct colors than palette slots: use them all, pad with black
+        centers = np.zeros((n_colors, 3), dtype=np.float32)
+        centers[: len(bins)] = colors
+    else:
+        print(f"  Quantizing {len(bins)} histogram bins into {n_colors} colors...")
+        # Each box is (error reduction of its best cut, lower-half mask, bins)
+        boxes = [(*split_color_box(colors, weights), np.arange(len(bins)))]
+        while len(boxes) < n_colors:
+            widest = max(range(len(boxes)), key=lambda i: boxes[i][0])
+            _, lower, members = boxes.pop(widest)
+            for half in (members[lower], members[~lower]):
+                if len(half) > 1:
+                    boxes.append((*split_color_box(colors[half], weights[half]), half))
+                else:
+                    boxes.append((-np.inf, None, half))
+
+        labels = np.empty(len(bins), dtype=np.intp)
+        for i, (_, _, members) in enumerate(boxes):
+            labels[members] = i
+        centers = weighted_means(colors, weights, labels, n_colors)
+
+        # One k-means refinement: reassign every bin to its nearest center
+        labels = build_palette_lut(centers)[bins]
+        refined = weighted_means(colors, weights, labels, n_colors)
+        used = np.bincount(labels, minlength=n_colors) > 0
+        centers[used] = refined[used]
+
+    palette = centers.astype(np.uint8)
     print(f"  Palette built ({n_colors} colors)")
-    return palette, kmeans
+    return palette, centers
+
+
+def build_palette_lut(centers: np.ndarray) -> np.ndarray:
+    """
+    Map every 15-bit RGB color (5 bits per channel) to its nearest palette
+    index, so per-cell palette lookup is a single array index.
+    """
+    coords = rgb15_colors(np.arange(1 << 15))
+    centers = centers.astype(np.float32)
+    dists = (
+        (coords**2).sum(axis=1)[:, None]
+        - 2 * coords @ centers.T
+        + (centers**2).sum(axis=1)[None, :]
+    )
+    return dists.argmin(axis=1).astype(np.uint8)
 
 
 def main():
@@ -161,6 +517,10 @@ def main():
     parser.add_argument("output", help="Output binary file path")
     parser.add_argument("--fps", type=int, default=12, help="Target frame rate (default: 12)")
     parser.add_argument("--cols", type=int, default=120, help="Character columns (default: 120)")
+    parser.add_argument(
+        "--device", default="cpu",
+        help="Glyph matching device: cpu (NumPy) or a torch device like cuda (default: cpu)",
+    )
     args = parser.parse_args()
 
     # Font setup — render glyphs at this size to build templates
@@ -190,62 +550,48 @@ def main():
     # Build character templates
     print("Step 1: Building glyph templates...")
     chars, templates = build_glyph_templates(font, cell_w, cell_h)
-    flat_templates = templates.reshape(len(chars), -1)
+    flat_templates = np.ascontiguousarray(
+        templates.reshape(len(chars), -1), dtype=np.float32,
+    )
     template_norms = np.linalg.norm(flat_templates, axis=1)
+    # Scale templates to unit norm once; the blank space template stays zero
+    flat_templates_n = flat_templates / np.maximum(template_norms, 1e-8)[:, None]
     print(f"  Built {len(chars)} character templates ({cell_w}x{cell_h}px each)")
 
-    with tempfile.TemporaryDirectory() as tmp_dir:
-        print("Step 2: Extracting frames...")
-        frame_paths = extract_frames(args.input, tmp_dir, args.fps, pixel_w, pixel_h)
-
-        print("Step 3: Loading frames...")
-        frames_rgb = []
-        frames_gray = []
-        for path in frame_paths:
-            img = Image.open(path).convert("RGB")
-            frames_rgb.append(np.array(img))
-            frames_gray.append(np.array(img.convert("L")))
-        print(f"  Loaded {len(frames_rgb)} frames")
-
-        print("Step 4: Building color palette...")
-        palette, kmeans = build_palette(frames_rgb)
-
-        print("Step 5: Structural matching (this may take a minute)...")
-        frames_data = []
-        for i in range(len(frames_rgb)):
-            frame_result = structural_match_frame(
-                frames_gray[i],
-                frames_rgb[i],
-                templates,
-                template_norms,
-                kmeans,
-                cols,
-                rows,
-                cell_w,
-                cell_h,
-            )
-            frames_data.append(frame_result)
-            if (i + 1) % 10 == 0 or (i + 1) == len(frames_rgb):
-                print(f"  Processed {i + 1}/{len(frames_rgb)} frames")
+    print("Step 2: Extracting frames and matching glyphs (this may take a minute)...")
+    ctx = MatchContext.build(
+        flat_templates_n, cols, rows, cell_w, cell_h, device=args.device,
+    )
+    char_idx, cell_colors, color_counts = analyze_frames(ctx, args.input, args.fps)
+    print(f"  Extracted {len(char_idx)} frames at {args.fps}fps, {pixel_w}x{pixel_h}")
+
+    print("Step 3: Building color palette...")
+    palette, palette_centers = build_palette(color_counts)
+    palette_lut = build_palette_lut(palette_centers)
+
+    print("Step 4: Matching colors...")
+    frames_data = np.empty((len(char_idx), rows, cols, 2), dtype=np.uint8)
+    frames_data[..., 0] = char_idx
+    frames_data[..., 1] = match_colors(cell_colors, palette_lut)
 
     # Write binary
-    print("Step 6: Writing binary...")
+    print("Step 5: Writing binary...")
     os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
     frame_count = len(frames_data)
 
     char_bytes = "".join(chars).encode("ascii")
 
+    # Header, char table and palette are assembled in memory and written at once
+    header = bytearray()
+    header += struct.pack("<HHHH", cols, rows, args.fps, frame_count)
+    header += struct.pack("<B", len(chars))
+    header += char_bytes
+    header += palette.tobytes()
+
     with open(args.output, "wb") as f:
-        # Header
-        f.write(struct.pack("<HHHH", cols, rows, args.fps, frame_count))
-        # Char table
-        f.write(struct.pack("<B", len(chars)))
-        f.write(char_bytes)
-        # Palette
-        f.write(palette.tobytes())
-        # Frames
-        for frame in frames_data:
-            f.write(frame.tobytes())
+        f.write(header)
+        # Frames: one contiguous (F, rows, cols, 2) buffer in a single write
+        frames_data.tofile(f)
 
     file_size = os.path.getsize(args.output)
     frame_size = cols * rows * 2